@@ -32,14 +32,23 @@ def create_app():
     app.config['DEBUG'] = os.getenv('DEBUG', 'True').lower() == 'true'
     
     # Inicia serviço com modelo transformers
+    from chat.config.settings import Config
     from chat.services.chat_service import chat_service
     from chat.models.chat_model import chat_model
     logging.info("Iniciando carregamento do modelo %s", chat_model.model_name)
-    chat_service.start_model_loading()
+    if Config.PRELOAD_MODEL:
+        # Carrega antes do fork dos workers (gunicorn --preload)
+        chat_service.preload_model()
+    else:
+        chat_service.start_model_loading()
 
     from chat.routes.chat_routes import chat_bp
     app.register_blueprint(chat_bp, url_prefix='/api/chat')
 
+    # SIGRTMIN (kill -s RTMIN <pid>) arma o profiling da geração para as próximas requisições
+    from chat.utils.profiling import install_signal_handler
+    install_signal_handler(requests=Config.PROFILE_SIGNAL_REQUESTS)
+
     @app.route('/api/chat/status', methods=['GET'])
     def status():
         return jsonify(chat_service.get_status())
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks das etapas do ChatModel (chat/models/chat_model.py).
+
+Mede, para conversas sintéticas de vários tamanhos e com seeds fixas:
+validação/sanitização, renderização do template, tokenização, prefill,
+decode por token, detokenização e o KV cache guardado entre turnos
+(memória por sessão e erro em fp/int8/int4). Salva os resultados como baseline JSON
+e falha (exit 1) quando alguma etapa regride além do limite.
+
+A comparação usa o tempo mínimo de cada etapa (menos sensível a ruído que a
+mediana) e só acusa regressões que se repetem em uma nova rodada. Baselines
+dependem da máquina e não são versionados: gere-os localmente.
+
+Uso:
+    python -m chat.benchmarks.bench_chat_model --save chat/benchmarks/baseline.json
+    python -m chat.benchmarks.bench_chat_model --compare chat/benchmarks/baseline.json
+    python -m chat.benchmarks.bench_chat_model --model /caminho/modelo-local
+
+Sem --model é usado um stub: GPT-2 minúsculo com pesos aleatórios e
+tokenizer BPE treinado em memória, sem download.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import torch
+
+from chat.models.chat_model import ChatModel
+from chat.models.inference_backend import create_backend
+from chat.models.kv_quant import QUANT_BITS, cache_nbytes, compress_cache, restore_cache
+from chat.utils.validators import validate_message_data, sanitize_message
+
+SEED = 1234
+WORDS = (
+    "olá tudo bem como você está hoje preciso de ajuda com o pedido entrega "
+    "produto valor pagamento prazo cidade endereço obrigado por favor quando onde"
+).split()
+
+
+def build_stub_model() -> ChatModel:
+    """ChatModel com tokenizer e modelo minúsculos construídos em memória"""
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+    from transformers import PreTrainedTokenizerFast, GPT2Config, GPT2LMHeadModel
+
+    tok = Tokenizer(models.BPE())
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=512,
+        special_tokens=["<|endoftext|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    rng = random.Random(SEED)
+    corpus = [" ".join(rng.choice(WORDS) for _ in range(30)) for _ in range(200)]
+    tok.train_from_iterator(corpus + ["User: Assistant: System:"] * 20, trainer)
+
+    torch.manual_seed(SEED)
+    chat_model = ChatModel(model_name="stub/tiny-gpt2", backend="torch")
+    chat_model.backend = create_backend("torch")
+    chat_model.tokenizer = PreTrainedTokenizerFast(tokenizer_object=tok, eos_token="<|endoftext|>")
+    chat_model.tokenizer.pad_token = chat_model.tokenizer.eos_token
+    chat_model.tokenizer.truncation_side = "left"
+    config = GPT2Config(
+        vocab_size=len(chat_model.tokenizer), n_positions=1024, n_embd=64, n_layer=2, n_head=2,
+        bos_token_id=0, eos_token_id=0,
+    )
+    chat_model.backend.model = GPT2LMHeadModel(config).eval()
+    chat_model.is_loaded = True
+    return chat_model
+
+
+def synthetic_message(rng: random.Random, n_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def build_session(chat_model: ChatModel, n_turns: int, rng: random.Random) -> str:
+    """Cria uma sessão com `n_turns` pares user/assistant sintéticos"""
+    session_id = chat_model.create_chat_session()
+    for _ in range(n_turns):
+        chat_model._append_message(session_id, "user", synthetic_message(rng, 20))
+        chat_model._append_message(session_id, "assistant", synthetic_message(rng, 40))
+    chat_model._append_message(session_id, "user", synthetic_message(rng, 20))
+    return session_id
+
+
+def torch_peak_kb(fn: Callable[[], Any]) -> float:
+    """Pico de memória (KB) alocada pelo torch durante uma execução de `fn`.
+
+    tracemalloc não enxerga as alocações dos tensores; o torch.profiler com
+    profile_memory registra cada alocação/liberação do alocador de CPU.
+    """
+    from torch.profiler import profile, ProfilerActivity
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    events = [e for e in prof.profiler.kineto_results.events() if e.name() == "[memory]"]
+    current = peak = 0
+    for event in sorted(events, key=lambda e: e.start_ns()):
+        current += event.nbytes()
+        peak = max(peak, current)
+    return round(peak / 1024, 1)
+
+
+def measure(fn: Callable[[], Any], repeat: int, warmup: int = 1) -> Dict[str, float]:
+    """Executa `fn` e retorna tempos (ms) e memória da etapa"""
+    for _ in range(warmup):
+        fn()
+    times = []
+    tracemalloc.start()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "median_ms": round(statistics.median(times), 4),
+        "min_ms": round(min(times), 4),
+        # Objetos Python (tokenizer, template...) e tensores do torch, respectivamente
+        "py_peak_kb": round(peak / 1024, 1),
+        "torch_peak_kb": torch_peak_kb(fn),
+    }
+
+
+def run_benchmarks(chat_model: ChatModel, history_lengths: List[int], repeat: int,
+                   decode_tokens: int) -> Dict[str, Dict[str, Any]]:
+    results: Dict[str, Dict[str, Any]] = {}
+    torch.manual_seed(SEED)
+    for n_turns in history_lengths:
+        rng = random.Random(SEED + n_turns)
+        session_id = build_session(chat_model, n_turns, rng)
+        raw_message = "  " + synthetic_message(rng, 40) + "\n\n\n\x07 fim  "
+        prompt_text = chat_model.build_prompt(session_id)
+        inputs = chat_model.backend.prepare_inputs(chat_model.tokenize_prompt(prompt_text))
+        input_ids, attention_mask = inputs["input_ids"], inputs.get("attention_mask")
+
+        def decode_loop():
+            logits, past = chat_model.backend.prefill(input_ids, attention_mask)
+            mask = attention_mask
+            for _ in range(decode_tokens):
+                next_id = logits.argmax(-1, keepdim=True)
+                if mask is not None:
+                    mask = torch.cat([mask, torch.ones_like(next_id)], dim=1)
+                logits, past = chat_model.backend.decode_step(next_id, past, mask)
+
+        generated = torch.randint(0, len(chat_model.tokenizer), (decode_tokens,),
+                                  generator=torch.Generator().manual_seed(SEED))
+
+        stages = {
+            "validate_sanitize": lambda: (
+                validate_message_data({"message": raw_message}), sanitize_message(raw_message)
+            ),
+            "template": lambda: chat_model.build_prompt(session_id),
+            "tokenize": lambda: chat_model.tokenize_prompt(prompt_text),
+            "prefill": lambda: chat_model.backend.prefill(input_ids, attention_mask),
+            "detokenize": lambda: chat_model.tokenizer.decode(generated, skip_special_tokens=True),
+        }
+        for stage, fn in stages.items():
+            results[f"{stage}@h{n_turns}"] = {**measure(fn, repeat), "prompt_tokens": input_ids.shape[1]}
+
+        # decode por token: (prefill + N passos - prefill) / N
+        loop = measure(decode_loop, max(1, repeat // 5))
+        prefill_ms = results[f"prefill@h{n_turns}"]["median_ms"]
+        per_token = max(0.0, (loop["median_ms"] - prefill_ms) / decode_tokens)
+        results[f"decode_per_token@h{n_turns}"] = {
+            **loop,
+            "median_ms": round(per_token, 4),
+            "min_ms": round(max(0.0, (loop["min_ms"] - prefill_ms) / decode_tokens), 4),
+            "prompt_tokens": input_ids.shape[1],
+        }
+        # KV cache guardado entre turnos: memória por sessão e custo de (de)quantização
+        _, past = chat_model.backend.prefill(input_ids, attention_mask)
+        if hasattr(past, "to_legacy_cache"):
+            reference = past.to_legacy_cache()
+            for mode in ["none", *QUANT_BITS]:
+                roundtrip = measure(lambda: restore_cache(compress_cache(past, mode)), repeat)
+                restored = restore_cache(compress_cache(past, mode)).to_legacy_cache()
+                error = max(
+                    float((r - o).abs().max() / o.abs().max().clamp(min=1e-8))
+                    for layer_r, layer_o in zip(restored, reference)
+                    for r, o in zip(layer_r, layer_o)
+                )
+                results[f"kv_{mode}@h{n_turns}"] = {
+                    **roundtrip,
+                    "prompt_tokens": input_ids.shape[1],
+                    "kv_kb": round(cache_nbytes(compress_cache(past, mode)) / 1024, 1),
+                    "max_rel_error": round(error, 5),
+                }
+        chat_model.clear_session(session_id)
+    return results
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Any], threshold: float,
+            min_delta_ms: float) -> Dict[str, str]:
+    """Etapas cujo tempo mínimo regrediu além de `threshold` (fração) e de `min_delta_ms`"""
+    regressions = {}
+    for stage, base in baseline.get("results", {}).items():
+        current = results.get(stage)
+        if current is None:
+            continue
+        before, after = base["min_ms"], current["min_ms"]
+        if after > before * (1 + threshold) and after - before > min_delta_ms:
+            regressions[stage] = (
+                f"{stage}: {before:.4f}ms -> {after:.4f}ms (+{(after / before - 1) * 100 if before else 0:.0f}%)"
+            )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Microbenchmarks do ChatModel")
+    parser.add_argument("--model", help="Caminho de um modelo local (padrão: stub em memória)")
+    parser.add_argument("--history", default="0,4,9", help="Turnos de histórico, separados por vírgula")
+    parser.add_argument("--repeat", type=int, default=20, help="Repetições por etapa")
+    parser.add_argument("--decode-tokens", type=int, default=32, help="Tokens no loop de decode")
+    parser.add_argument("--threads", type=int, default=1, help="torch.set_num_threads (estabilidade)")
+    parser.add_argument("--save", help="Salva os resultados como baseline JSON")
+    parser.add_argument("--compare", help="Compara com um baseline JSON e falha se regredir")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Regressão tolerada (fração)")
+    parser.add_argument("--min-delta-ms", type=float, default=0.25, help="Diferença mínima absoluta")
+    parser.add_argument("--confirm-runs", type=int, default=2,
+                        help="Rodadas extras em que uma regressão precisa se repetir")
+    args = parser.parse_args()
+
+    random.seed(SEED)
+    torch.manual_seed(SEED)
+    torch.set_num_threads(args.threads)
+
+    if args.model:
+        chat_model = ChatModel(model_name=args.model)
+        chat_model.load_model()
+    else:
+        chat_model = build_stub_model()
+
+    history_lengths = [int(h) for h in args.history.split(",") if h.strip()]
+    results = run_benchmarks(chat_model, history_lengths, args.repeat, args.decode_tokens)
+
+    print(f"{'etapa':<32}{'mediana ms':>12}{'min ms':>10}{'py KB':>10}{'torch KB':>10}{'tokens':>8}")
+    for stage, r in results.items():
+        extra = f"  KV {r['kv_kb']} KB, erro {r['max_rel_error']}" if "kv_kb" in r else ""
+        print(f"{stage:<32}{r['median_ms']:>12.4f}{r['min_ms']:>10.4f}{r['py_peak_kb']:>10.1f}"
+              f"{r['torch_peak_kb']:>10.1f}{r['prompt_tokens']:>8}{extra}")
+
+    report = {
+        "model": chat_model.model_name,
+        "backend": chat_model.backend.name,
+        "torch_threads": args.threads,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.save:
+        Path(args.save).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"💾 Baseline salvo em {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_delta_ms)
+        # Uma regressão só conta se reaparecer nas rodadas de confirmação (ruído é pontual)
+        for _ in range(args.confirm_runs):
+            if not regressions:
+                break
+            rerun = run_benchmarks(chat_model, history_lengths, args.repeat, args.decode_tokens)
+            again = compare(rerun, baseline, args.threshold, args.min_delta_ms)
+            regressions = {stage: again[stage] for stage in regressions if stage in again}
+        if regressions:
+            print("❌ Regressões de desempenho:")
+            for line in regressions.values():
+                print(f"   {line}")
+            return 1
+        print("✅ Nenhuma regressão acima do limite")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
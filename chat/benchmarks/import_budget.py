@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Orçamento de tempo de boot da API.
+
+Em processos novos (sem cache de imports em memória), mede:
+- o custo de import por módulo (`python -X importtime`) da camada HTTP:
+  chat.app, rotas, serviço e validadores;
+- se torch/transformers foram importados (não devem ser: ficam para a
+  thread de carregamento do modelo);
+- o tempo do início do processo até a primeira resposta de
+  /api/chat/health.
+
+Falha (exit 1) quando algum limite é excedido.
+
+Uso:
+    python -m chat.benchmarks.import_budget
+    python -m chat.benchmarks.import_budget --budget-ms 800 --top 20
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+
+# Módulos que só podem ser importados ao carregar o modelo
+HEAVY_MODULES = ("torch", "transformers", "optimum", "onnxruntime")
+# Profundidade máxima (no grafo de imports) dos módulos listados no relatório
+MAX_DEPTH = 2
+API_MODULES = (
+    "chat.app",
+    "chat.routes.chat_routes",
+    "chat.services.chat_service",
+    "chat.utils.validators",
+)
+
+_IMPORT_SCRIPT = f"""
+import sys, json
+for name in {API_MODULES!r}:
+    __import__(name)
+print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))
+"""
+
+# O modelo é carregado em background por create_app; o processo termina
+# logo após a resposta, sem esperar a thread de carregamento
+_HEALTH_SCRIPT = """
+import os, json
+from chat.app import create_app
+app = create_app()
+response = app.test_client().get('/api/chat/health')
+print(json.dumps({"status": response.status_code}), flush=True)
+os._exit(0)
+"""
+
+
+def _run(script: str, *python_flags: str) -> subprocess.CompletedProcess:
+    env = {**os.environ, "PYTHONPATH": str(PROJECT_ROOT), "PRELOAD_MODEL": "false"}
+    return subprocess.run(
+        [sys.executable, *python_flags, "-c", script],
+        cwd=PROJECT_ROOT, env=env, capture_output=True, text=True, timeout=300,
+    )
+
+
+def import_costs() -> Tuple[List[Tuple[str, int]], List[str]]:
+    """(módulos por custo cumulativo em µs, módulos pesados importados)"""
+    proc = _run(_IMPORT_SCRIPT, "-X", "importtime")
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr else "falha no import")
+    costs: Dict[str, int] = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Até dois níveis de aninhamento; os mais internos já entram no cumulativo do pai
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth > MAX_DEPTH:
+            continue
+        costs[name.strip()] = int(cumulative)
+    heavy = json.loads(proc.stdout.strip().splitlines()[-1])
+    return sorted(costs.items(), key=lambda item: item[1], reverse=True), heavy
+
+
+def time_to_health() -> float:
+    """Tempo (ms) do início do processo até a primeira resposta de /health"""
+    start = time.perf_counter()
+    proc = _run(_HEALTH_SCRIPT)
+    elapsed = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0 or '"status": 200' not in proc.stdout:
+        raise RuntimeError(f"health check falhou: {proc.stdout.strip()} {proc.stderr.strip()[-500:]}")
+    return elapsed
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Orçamento de tempo de boot da API")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("BOOT_BUDGET_MS", 1500)),
+                        help="Tempo máximo até a primeira resposta de /health (ms)")
+    parser.add_argument("--top", type=int, default=15, help="Módulos listados no relatório")
+    parser.add_argument("--repeat", type=int, default=3, help="Execuções de /health (usa a mediana)")
+    args = parser.parse_args()
+
+    costs, heavy = import_costs()
+    print(f"{'módulo':<40}{'cumulativo ms':>14}")
+    for name, cumulative in costs[:args.top]:
+        print(f"{name:<40}{cumulative / 1000:>14.1f}")
+
+    timings = sorted(time_to_health() for _ in range(max(1, args.repeat)))
+    boot_ms = timings[len(timings) // 2]
+    print(f"\n⏱️  Início do processo -> /health: {boot_ms:.0f}ms (limite {args.budget_ms:.0f}ms)")
+
+    failures = []
+    if heavy:
+        failures.append(f"módulos pesados importados pela camada HTTP: {', '.join(heavy)}")
+    if boot_ms > args.budget_ms:
+        failures.append(f"boot acima do limite: {boot_ms:.0f}ms > {args.budget_ms:.0f}ms")
+    if failures:
+        print("❌ Orçamento de boot excedido:")
+        for line in failures:
+            print(f"   {line}")
+        return 1
+    print("✅ Boot dentro do orçamento")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
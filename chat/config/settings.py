@@ -14,6 +14,11 @@ class Config:
     MAX_MESSAGE_LENGTH = int(os.getenv('MAX_MESSAGE_LENGTH', 1000))
     DEFAULT_TEMPERATURE = float(os.getenv('DEFAULT_TEMPERATURE', 0.7))
     MAX_HISTORY_LENGTH = int(os.getenv('MAX_HISTORY_LENGTH', 10))
+    INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'torch').lower()  # torch | onnx
+    PRELOAD_MODEL = os.getenv('PRELOAD_MODEL', 'False').lower() in ('1', 'true')
+    SHARED_WEIGHTS_FILE = os.getenv('SHARED_WEIGHTS_FILE')
+    KV_CACHE_QUANT = os.getenv('KV_CACHE_QUANT', 'none').lower()  # none | int8 | int4
+    KV_CACHE_MAX_TOKENS = int(os.getenv('KV_CACHE_MAX_TOKENS', 0))
     
     # Configurações de CORS
     CORS_ORIGINS = os.getenv('CORS_ORIGINS', 'http://localhost:5173,http://localhost:3000').split(',')
@@ -22,9 +27,20 @@ class Config:
     LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
     LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     
+    # Configurações de profiling (endpoint /admin/profile exige ADMIN_TOKEN)
+    ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+    PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+    PROFILE_SIGNAL_REQUESTS = int(os.getenv('PROFILE_SIGNAL_REQUESTS', 5))
+    
     # Configurações de timeout
     MODEL_LOADING_TIMEOUT = int(os.getenv('MODEL_LOADING_TIMEOUT', 300))  # 5 minutos
-    REQUEST_TIMEOUT = int(os.getenv('REQUEST_TIMEOUT', 60))  # 1 minuto
+    REQUEST_TIMEOUT = int(os.getenv('REQUEST_TIMEOUT', 60))  # 1 minuto; prazo de cada geração (0 desativa)
+    
+    # Degradação sob carga (limites de geração adaptativos)
+    LOAD_QUEUE_THRESHOLD = int(os.getenv('LOAD_QUEUE_THRESHOLD', 2))
+    LATENCY_SLO_SECONDS = float(os.getenv('LATENCY_SLO_SECONDS', 15))  # 0 desativa o critério de latência
+    LOAD_RECOVERY_SECONDS = float(os.getenv('LOAD_RECOVERY_SECONDS', 30))
+    LATENCY_EWMA_ALPHA = float(os.getenv('LATENCY_EWMA_ALPHA', 0.3))
     
     @classmethod
     def get_model_config(cls) -> Dict[str, Any]:
@@ -33,7 +49,8 @@ class Config:
             'model_name': cls.DEFAULT_MODEL,
             'max_length': cls.MAX_MESSAGE_LENGTH,
             'temperature': cls.DEFAULT_TEMPERATURE,
-            'max_history': cls.MAX_HISTORY_LENGTH
+            'max_history': cls.MAX_HISTORY_LENGTH,
+            'inference_backend': cls.INFERENCE_BACKEND
         }
     
     @classmethod
@@ -0,0 +1,47 @@
+"""
+Configuração do gunicorn.
+
+Com PRELOAD_MODEL=1 o app (e o modelo) é carregado uma única vez no master
+antes do fork, e os workers compartilham os pesos em copy-on-write.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv('GUNICORN_WORKERS', 1))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+# Workers com threads: requisições concorrentes no mesmo processo, para que
+# in_flight (fila da política de degradação) passe de 1 e /cancel alcance a
+# geração em andamento. O worker sync atende uma requisição por vez.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+preload_app = os.getenv('PRELOAD_MODEL', 'False').lower() in ('1', 'true')
+
+
+def when_ready(server):
+    """Instala no master o handler do sinal de profiling.
+
+    Sem --preload o app só é criado nos workers; sem o handler, o sinal
+    enviado ao master por engano o encerraria (ação padrão do SIGRTMIN).
+    Com --preload o create_app já o instalou no master.
+    """
+    if preload_app:
+        return
+    from chat.config.settings import Config
+    from chat.utils.profiling import install_signal_handler
+    install_signal_handler(requests=Config.PROFILE_SIGNAL_REQUESTS)
+
+
+def post_fork(server, worker):
+    """Ajusta cada worker após o fork"""
+    # Divide os núcleos entre os workers para não disputarem o intra-op do torch
+    threads = os.getenv('TORCH_THREADS_PER_WORKER')
+    if threads:
+        import torch
+        torch.set_num_threads(int(threads))
+
+    if not preload_app:
+        return
+    from chat.services.chat_service import chat_service
+    # Se o preload falhou no master, cada worker tenta carregar por conta própria
+    if not chat_service.model_loaded:
+        chat_service.start_model_loading()
@@ -1,10 +1,19 @@
 import os
-from transformers import AutoTokenizer, AutoModelForCausalLM
-import torch
 import logging
-from typing import Dict, Any, List, Literal
+from typing import TYPE_CHECKING, Dict, Any, List, Literal
 import uuid
+import time
+import threading
 from datetime import datetime
+from chat.config.settings import Config
+from chat.models.prefix_cache import PrefixCache, DraftPrefillWorker
+from chat.utils.profiling import profiler
+
+if TYPE_CHECKING:
+    from chat.models.inference_backend import InferenceBackend
+
+# torch, transformers e os backends são importados sob demanda (em load_model
+# e na geração): importar este módulo não pode atrasar o boot da API
 
 # Configuração de logging
 logging.basicConfig(level=logging.INFO)
@@ -25,23 +34,52 @@ SYSTEM_PROMPT = os.getenv(
     "SYSTEM_PROMPT",
     "Você é um assistente útil, conciso e responde sempre em português claro."
 )
+# Remoções de histórico lembradas por sessão (para o cursor `since`)
+MAX_TRACKED_REMOVALS = 32
 
 MessageRole = Literal["system", "user", "assistant"]
+FinishReason = Literal["stop", "length", "cancelled", "deadline"]
 
 class ChatModel:
-    def __init__(self, model_name: str = DEFAULT_MODEL, system_prompt: str | None = None):
+    def __init__(self, model_name: str = DEFAULT_MODEL, system_prompt: str | None = None,
+                 backend: str | None = None):
         self.model_name = model_name
         self.system_prompt = system_prompt or SYSTEM_PROMPT
         self.tokenizer = None
-        self.model = None
-        # chat_history[session_id] = list[ {role, content} ]
-        self.chat_history: dict[str, List[dict[str, str]]] = {}
+        self.backend_name = backend
+        self.backend: "InferenceBackend | None" = None
+        # chat_history[session_id] = list[ {role, content, seq} ]
+        self.chat_history: dict[str, List[dict[str, Any]]] = {}
+        # Último número de sequência atribuído por sessão (monotônico, nunca reutilizado)
+        self.history_seq: dict[str, int] = {}
+        # Mensagens removidas (regenerate) por sessão: (seq removido, último seq no momento)
+        self.history_removed: dict[str, List[tuple[int, int]]] = {}
+        # Eventos de cancelamento das gerações em andamento, por sessão
+        self._cancel_events: dict[str, threading.Event] = {}
+        # KV cache de prefixos pré-processados (rascunhos) por sessão
+        self.prefix_cache = PrefixCache()
+        self._draft_worker: DraftPrefillWorker | None = None
+        self._draft_lock = threading.Lock()
+        # Contador de gerações por sessão: um prefill de rascunho iniciado antes
+        # de uma geração não pode sobrescrever o cache que ela guardou
+        self._generation_epoch: dict[str, int] = {}
+        self._epoch_lock = threading.Lock()
         self.is_loaded = False
         
+    @property
+    def model(self):
+        return self.backend.model if self.backend is not None else None
+
     def load_model(self):
         """Carrega o modelo e tokenizer"""
+        import torch
+        from transformers import AutoTokenizer
+        from chat.models.inference_backend import create_backend
+
         try:
-            logger.info(f"Carregando modelo: {self.model_name}")
+            if self.backend is None:
+                self.backend = create_backend(self.backend_name)
+            logger.info(f"Carregando modelo: {self.model_name} (backend: {self.backend.name})")
             if torch.cuda.is_available():
                 logger.info(f"CUDA disponível - usando GPU: {torch.cuda.get_device_name(0)}")
             else:
@@ -69,7 +107,7 @@ class ChatModel:
                 self.tokenizer = AutoTokenizer.from_pretrained(
                     self.model_name, trust_remote_code=True, **token_kwargs
                 )
-                self.model = AutoModelForCausalLM.from_pretrained(
+                self.backend.load_model(
                     self.model_name, trust_remote_code=True, **load_kwargs, **token_kwargs
                 )
             except Exception as e_first:
@@ -93,7 +131,7 @@ class ChatModel:
                                 self.tokenizer = AutoTokenizer.from_pretrained(
                                     fb, trust_remote_code=True, **token_kwargs
                                 )
-                                self.model = AutoModelForCausalLM.from_pretrained(
+                                self.backend.load_model(
                                     fb, trust_remote_code=True, **load_kwargs, **token_kwargs
                                 )
                                 self.model_name = fb
@@ -108,6 +146,8 @@ class ChatModel:
 
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
+            # Prompts longos perdem o início (histórico antigo), nunca o turno atual
+            self.tokenizer.truncation_side = "left"
 
             self.is_loaded = True
             logger.info("Modelo carregado com sucesso!")
@@ -121,81 +161,366 @@ class ChatModel:
     
     def create_chat_session(self) -> str:
         session_id = str(uuid.uuid4())
-        self.chat_history[session_id] = [{"role": "system", "content": self.system_prompt}]
+        self.chat_history[session_id] = []
+        self.history_seq[session_id] = 0
+        self._append_message(session_id, "system", self.system_prompt)
         logger.info(f"Nova sessão criada: {session_id}")
         return session_id
     
+    def _append_message(self, session_id: str, role: MessageRole, content: str) -> int:
+        """Adiciona uma mensagem ao histórico com o próximo número de sequência"""
+        seq = self.history_seq.get(session_id, 0) + 1
+        self.history_seq[session_id] = seq
+        self.chat_history[session_id].append({"role": role, "content": content, "seq": seq})
+        return seq
+
+    def _prompt_messages(self, session_id: str) -> List[dict[str, str]]:
+        """Histórico no formato {role, content} esperado pelos templates de chat"""
+        return [{"role": m["role"], "content": m["content"]} for m in self.chat_history[session_id]]
+
+    def prompt_template(self) -> str:
+        """Template de prompt do modelo: 'chatml' (chat template) ou 'transcript'"""
+        is_qwen_like = "qwen" in self.model_name.lower()
+        if is_qwen_like and hasattr(self.tokenizer, "apply_chat_template"):
+            return "chatml"
+        return "transcript"
+
+    def build_prompt(self, session_id: str, history_turns: int | None = None,
+                     pending_user_message: str | None = None) -> str:
+        """Renderiza o histórico da sessão como prompt para a próxima resposta.
+
+        `history_turns` (padrão: MAX_HISTORY_LENGTH) limita o prompt aos últimos
+        N pares user/assistant (além do system prompt e da mensagem atual).
+        `pending_user_message` é tratada como a mensagem atual sem ser gravada
+        no histórico.
+        """
+        messages = self._prompt_messages(session_id)
+        if pending_user_message is not None:
+            messages.append({"role": "user", "content": pending_user_message})
+        if history_turns is None:
+            history_turns = Config.MAX_HISTORY_LENGTH
+        keep = 2 * history_turns + 1
+        if len(messages) > keep + 1:
+            messages = messages[:1] + messages[-keep:]
+        if self.prompt_template() == "chatml":
+            return self.tokenizer.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=True
+            )
+        turns: List[str] = []
+        for m in messages:
+            r = m["role"].capitalize()
+            turns.append(f"{r}: {m['content']}")
+        turns.append("Assistant:")
+        return "\n".join(turns)
+
+    def tokenize_prompt(self, prompt_text: str, max_prompt_tokens: int = 1024):
+        return self.tokenizer(
+            prompt_text, return_tensors="pt", truncation=True, max_length=max_prompt_tokens
+        )
+
+    def submit_draft(self, session_id: str, draft: str, history_turns: int | None = None,
+                     max_prompt_tokens: int = 1024) -> bool:
+        """Agenda o prefill especulativo de histórico + rascunho em background.
+
+        Retorna False quando o backend não reaproveita KV cache ou a sessão
+        já está gerando uma resposta.
+        """
+        if not self.is_loaded:
+            raise RuntimeError("Modelo não foi carregado. Chame load_model() primeiro.")
+        if session_id not in self.chat_history:
+            raise ValueError(f"Sessão {session_id} não encontrada")
+        if not self.backend.supports_prefix_cache or session_id in self._cancel_events:
+            return False
+
+        prompt_text = self.build_prompt(session_id, history_turns, pending_user_message=draft)
+        with self._draft_lock:
+            if self._draft_worker is None:
+                self._draft_worker = DraftPrefillWorker(self._prefill_draft)
+        self._draft_worker.submit(session_id, (prompt_text, max_prompt_tokens))
+        return True
+
+    def _prefill_draft(self, session_id: str, payload):
+        prompt_text, max_prompt_tokens = payload
+        if session_id not in self.chat_history or session_id in self._cancel_events:
+            return
+        epoch = self._generation_epoch.get(session_id, 0)
+        inputs = self.backend.prepare_inputs(self.tokenize_prompt(prompt_text, max_prompt_tokens))
+        input_ids, attention_mask = inputs["input_ids"], inputs.get("attention_mask")
+        # Rascunhos sucessivos compartilham prefixo: estende o cache do anterior
+        past = self.prefix_cache.take(session_id, input_ids[0])
+        if past is not None:
+            _, past = self.backend.decode_step(
+                input_ids[:, past.get_seq_length():], past, attention_mask
+            )
+        else:
+            _, past = self.backend.prefill(input_ids, attention_mask)
+        with self._epoch_lock:
+            # A mensagem real chegou (ou a sessão foi limpa) durante o prefill:
+            # o cache guardado pela geração vale mais que o do rascunho
+            if (session_id not in self.chat_history
+                    or self._generation_epoch.get(session_id, 0) != epoch):
+                return
+            self.prefix_cache.put(session_id, input_ids[0], past)
+
+    def cancel_generation(self, session_id: str) -> bool:
+        """Sinaliza o cancelamento da geração em andamento da sessão"""
+        event = self._cancel_events.get(session_id)
+        if event is None:
+            return False
+        event.set()
+        return True
+
     def generate_response(self, session_id: str, user_message: str,
-                          max_length: int = 512, temperature: float = 0.7) -> Dict[str, Any]:
+                          max_length: int = 512, temperature: float = 0.7,
+                          stop: List[str] | None = None, max_prompt_tokens: int = 1024,
+                          history_turns: int | None = None, n: int = 1,
+                          timeout: float | None = None) -> Dict[str, Any]:
+        """Gera a resposta para `user_message`.
+
+        Com `timeout` (segundos), a geração para no primeiro passo de
+        decodificação após o prazo e retorna o texto parcial com
+        finish_reason "deadline".
+        """
         if not self.is_loaded:
             raise RuntimeError("Modelo não foi carregado. Chame load_model() primeiro.")
         if session_id not in self.chat_history:
             raise ValueError(f"Sessão {session_id} não encontrada")
 
-        try:
-            self.chat_history[session_id].append({"role": "user", "content": user_message})
+        with profiler.request("generate"):
+            return self._generate_response(
+                session_id, user_message, max_length=max_length, temperature=temperature,
+                stop=stop, max_prompt_tokens=max_prompt_tokens, history_turns=history_turns, n=n,
+                timeout=timeout
+            )
 
-            is_qwen_like = "qwen" in self.model_name.lower()
+    def regenerate_response(self, session_id: str,
+                            max_length: int = 512, temperature: float = 0.7,
+                            stop: List[str] | None = None, max_prompt_tokens: int = 1024,
+                            history_turns: int | None = None, n: int = 1,
+                            timeout: float | None = None) -> Dict[str, Any]:
+        """Substitui a última resposta do assistente por uma nova geração.
 
-            if is_qwen_like and hasattr(self.tokenizer, "apply_chat_template"):
-                prompt_text = self.tokenizer.apply_chat_template(
-                    self.chat_history[session_id], tokenize=False, add_generation_prompt=True
+        O prompt é o mesmo da resposta anterior, então o KV cache guardado ao
+        fim da geração anterior evita repetir o prefill.
+        """
+        if not self.is_loaded:
+            raise RuntimeError("Modelo não foi carregado. Chame load_model() primeiro.")
+        if session_id not in self.chat_history:
+            raise ValueError(f"Sessão {session_id} não encontrada")
+
+        history = self.chat_history[session_id]
+        replaced = history.pop() if history[-1]["role"] == "assistant" else None
+        removed_at = self.history_seq[session_id]
+        if history[-1]["role"] != "user":
+            if replaced is not None:
+                history.append(replaced)
+            raise LookupError("Nenhuma mensagem do usuário para regenerar")
+        try:
+            with profiler.request("regenerate"):
+                result = self._generate_response(
+                    session_id, None, max_length=max_length, temperature=temperature,
+                    stop=stop, max_prompt_tokens=max_prompt_tokens, history_turns=history_turns, n=n,
+                    timeout=timeout
                 )
-                inputs = self.tokenizer(prompt_text, return_tensors="pt", truncation=True, max_length=1024)
-            else:
-                turns: List[str] = []
-                for m in self.chat_history[session_id][-12:]:
-                    r = m["role"].capitalize()
-                    turns.append(f"{r}: {m['content']}")
-                turns.append("Assistant:")
-                prompt_text = "\n".join(turns)
-                inputs = self.tokenizer(prompt_text, return_tensors="pt", truncation=True, max_length=1024)
+        except Exception:
+            if replaced is not None and history[-1]["role"] == "user":
+                history.append(replaced)
+            raise
+        if replaced is not None:
+            removed = self.history_removed.setdefault(session_id, [])
+            removed.append((replaced["seq"], removed_at))
+            # Cursores muito antigos recebem só as remoções recentes
+            del removed[:-MAX_TRACKED_REMOVALS]
+        result["replaces_seq"] = replaced["seq"] if replaced is not None else None
+        return result
+
+    def _finish_candidate(self, generated, stop_sequences: List[str], max_new_tokens: int,
+                          cancelled: bool, expired: bool = False) -> Dict[str, Any]:
+        """Detokeniza uma sequência gerada, corta nas stop sequences e classifica o fim"""
+        from chat.models.stopping import trim_at_stop
+
+        # Stop sequences especiais (ex.: <|im_end|>) só aparecem na decodificação bruta
+        raw_text = self.tokenizer.decode(generated, skip_special_tokens=False)
+        _, stopped = trim_at_stop(raw_text, stop_sequences)
+        response, _ = trim_at_stop(
+            self.tokenizer.decode(generated, skip_special_tokens=True), stop_sequences
+        )
+        response = response.strip()
+
+        finish_reason: FinishReason
+        if cancelled:
+            finish_reason = "cancelled"
+        elif stopped or self.tokenizer.eos_token_id in generated.tolist():
+            finish_reason = "stop"
+        elif len(generated) >= max_new_tokens:
+            finish_reason = "length"
+        elif expired:
+            finish_reason = "deadline"
+        else:
+            finish_reason = "stop"
+
+        if "qwen" in self.model_name.lower() and response.lower().startswith("assistant:"):
+            response = response.split(":", 1)[1].strip()
+        return {"response": response, "finish_reason": finish_reason}
+
+    def _generate_response(self, session_id: str, user_message: str | None, *, max_length: int,
+                           temperature: float, stop: List[str] | None, max_prompt_tokens: int,
+                           history_turns: int | None, n: int,
+                           timeout: float | None = None) -> Dict[str, Any]:
+        import torch
+        from transformers import StoppingCriteriaList
+        from chat.models.stopping import (
+            TEMPLATE_STOP_SEQUENCES, StopSequenceCriteria, CancelCriteria, DeadlineCriteria,
+            FirstTokenCallback
+        )
+
+        # O prazo conta desde a chegada aqui (inclui template e tokenização)
+        deadline = DeadlineCriteria(time.monotonic() + timeout) if timeout else None
+        cancel_event = threading.Event()
+        with self._epoch_lock:
+            self._generation_epoch[session_id] = self._generation_epoch.get(session_id, 0) + 1
+        self._cancel_events[session_id] = cancel_event
+        if self._draft_worker is not None:
+            self._draft_worker.cancel(session_id)
+        try:
+            # user_message None: regeneração a partir da última mensagem do usuário
+            if user_message is not None:
+                self._append_message(session_id, "user", user_message)
+
+            template = self.prompt_template()
+            stop_sequences = TEMPLATE_STOP_SEQUENCES[template] + list(stop or [])
+
+            with profiler.stage("template"):
+                prompt_text = self.build_prompt(session_id, history_turns)
+            with profiler.stage("tokenize"):
+                inputs = self.tokenize_prompt(prompt_text, max_prompt_tokens)
 
             input_len = inputs["input_ids"].shape[1]
+            max_new_tokens = min(max_length, 384)
+            n = max(1, n)
             gen_kwargs = {
-                "max_new_tokens": min(max_length, 384),
+                "max_new_tokens": max_new_tokens,
                 "temperature": temperature,
                 "top_p": 0.9,
                 "top_k": 50,
                 "do_sample": True,
                 "repetition_penalty": 1.12,
                 "pad_token_id": self.tokenizer.eos_token_id,
+                "stopping_criteria": StoppingCriteriaList([
+                    StopSequenceCriteria(self.tokenizer, stop_sequences, input_len),
+                    CancelCriteria(cancel_event),
+                ]),
+                "return_dict_in_generate": True,
             }
-            if torch.cuda.is_available():
-                inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
-
-            with torch.no_grad():
-                output_ids = self.model.generate(**inputs, **gen_kwargs)
+            if deadline is not None:
+                gen_kwargs["stopping_criteria"].append(deadline)
+            inputs = self.backend.prepare_inputs(inputs)
+            # Reaproveita o KV cache do rascunho ou da resposta anterior:
+            # só o sufixo novo passa por prefill
+            past = self.prefix_cache.take(session_id, inputs["input_ids"][0])
+            if n > 1 and self.backend.supports_prefix_cache:
+                # Candidatos compartilham um único prefill do prompt (menos o
+                # último token, que gera os logits de cada candidato)
+                if past is None and input_len > 1:
+                    _, past = self.backend.prefill(
+                        inputs["input_ids"][:, :-1], inputs["attention_mask"][:, :-1]
+                    )
+                if past is not None:
+                    past.batch_repeat_interleave(n)
+                inputs = {k: v.repeat(n, 1) for k, v in inputs.items()}
+            elif n > 1:
+                gen_kwargs["num_return_sequences"] = n
+            if past is not None:
+                gen_kwargs["past_key_values"] = past
+            gen_start = time.perf_counter()
+            if profiler.active:
+                # Separa prefill (até o primeiro token) de decode no perfil
+                gen_kwargs["stopping_criteria"].append(
+                    FirstTokenCallback(lambda: profiler.mark("prefill", gen_start))
+                )
+            with profiler.stage("generate"):
+                output = self.backend.generate(inputs, **gen_kwargs)
+            output_ids = output.sequences
 
-            generated = output_ids[0][input_len:]
-            response = self.tokenizer.decode(generated, skip_special_tokens=True).strip()
+            with profiler.stage("detokenize"):
+                candidates = [
+                    self._finish_candidate(row[input_len:], stop_sequences, max_new_tokens,
+                                           cancel_event.is_set(),
+                                           deadline is not None and deadline.expired)
+                    for row in output_ids
+                ]
+            response = candidates[0]["response"]
+            finish_reason = candidates[0]["finish_reason"]
+            if finish_reason == "deadline":
+                logger.warning(
+                    f"Prazo de {timeout}s esgotado na sessão {session_id}; "
+                    f"resposta parcial com {len(output_ids[0]) - input_len} tokens"
+                )
 
-            if is_qwen_like and response.lower().startswith("assistant:"):
-                response = response.split(":", 1)[1].strip()
+            # Guarda o KV cache do prompt + resposta registrada (candidato 0):
+            # serve para regenerar e como prefixo do próximo turno
+            cache = getattr(output, "past_key_values", None)
+            if self.backend.supports_prefix_cache and hasattr(cache, "get_seq_length"):
+                if output_ids.shape[0] > 1:
+                    cache.batch_select_indices(torch.tensor([0], device=output_ids.device))
+                self.prefix_cache.put(session_id, output_ids[0], cache)
 
-            self.chat_history[session_id].append({"role": "assistant", "content": response})
+            seq = self._append_message(session_id, "assistant", response)
 
-            # Limita histórico: mantém system + últimos 18 turnos (9 pares)
-            if len(self.chat_history[session_id]) > 1 + 18:
+            # Limita histórico: mantém system + últimos MAX_HISTORY_LENGTH pares
+            max_stored = 2 * Config.MAX_HISTORY_LENGTH
+            if len(self.chat_history[session_id]) > 1 + max_stored:
                 base = [self.chat_history[session_id][0]]
-                self.chat_history[session_id] = base + self.chat_history[session_id][-18:]
+                self.chat_history[session_id] = base + self.chat_history[session_id][-max_stored:]
 
-            return {
+            result = {
                 "response": response,
                 "session_id": session_id,
                 "timestamp": datetime.now().isoformat(),
-                "model": self.model_name
+                "model": self.model_name,
+                "seq": seq,
+                "finish_reason": finish_reason
             }
+            if n > 1:
+                result["candidates"] = candidates
+            return result
         except Exception as e:
             logger.error(f"Erro ao gerar resposta: {str(e)}")
             raise
+        finally:
+            if self._cancel_events.get(session_id) is cancel_event:
+                del self._cancel_events[session_id]
     
-    def get_chat_history(self, session_id: str) -> list:
-        return self.chat_history.get(session_id, [])
+    def get_chat_history(self, session_id: str, since: int | None = None) -> list:
+        """Retorna o histórico; com `since`, apenas mensagens com seq > since"""
+        history = self.chat_history.get(session_id, [])
+        if since is None:
+            return history
+        # seq é crescente na lista: percorre do fim até achar o cursor
+        start = len(history)
+        while start > 0 and history[start - 1]["seq"] > since:
+            start -= 1
+        return history[start:]
+
+    def get_removed_seqs(self, session_id: str, since: int) -> List[int]:
+        """Seqs que um cliente com cursor `since` já recebeu e que foram removidos depois"""
+        return [
+            seq for seq, removed_at in self.history_removed.get(session_id, [])
+            if seq <= since <= removed_at
+        ]
+
+    def get_history_seq(self, session_id: str) -> int:
+        """Último número de sequência da sessão (0 se não existir)"""
+        return self.history_seq.get(session_id, 0)
     
     def clear_session(self, session_id: str):
         if session_id in self.chat_history:
             del self.chat_history[session_id]
+            self.history_seq.pop(session_id, None)
+            self.history_removed.pop(session_id, None)
+            with self._epoch_lock:
+                self._generation_epoch.pop(session_id, None)
+            self.prefix_cache.discard(session_id)
             logger.info(f"Sessão {session_id} limpa")
     
     def get_model_info(self) -> Dict[str, Any]:
@@ -203,6 +528,9 @@ class ChatModel:
         return {
             "model_name": self.model_name,
             "is_loaded": self.is_loaded,
+            "inference_backend": (self.backend.info() if self.backend is not None
+                                  else {"backend": self.backend_name or Config.INFERENCE_BACKEND}),
+            "prefix_cache": self.prefix_cache.info(),
             "active_sessions": len(self.chat_history)
         }
 
@@ -0,0 +1,197 @@
+import os
+import shutil
+import logging
+import tempfile
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+from transformers import AutoModelForCausalLM
+
+from chat.config.settings import Config
+
+logger = logging.getLogger(__name__)
+
+"""Backends de inferência do ChatModel.
+
+Cada backend encapsula o modelo carregado e expõe as etapas de inferência
+(prefill, passo de decodificação com KV cache e geração com streaming), de
+modo que o ChatModel não dependa de uma engine específica.
+"""
+
+ONNX_CACHE_DIR = os.getenv(
+    "ONNX_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "chat_onnx")
+)
+
+
+class InferenceBackend:
+    """Interface comum dos backends de inferência"""
+
+    name = "base"
+    # Se o KV cache retornado por prefill() pode ser passado a generate()
+    supports_prefix_cache = False
+
+    def __init__(self):
+        self.model = None
+
+    def load_model(self, model_name: str, **kwargs):
+        raise NotImplementedError
+
+    @property
+    def device(self):
+        return torch.device("cpu")
+
+    def prepare_inputs(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """Move os tensores de entrada para o dispositivo do modelo"""
+        return {k: v.to(self.device) for k, v in inputs.items()}
+
+    def prefill(self, input_ids, attention_mask=None) -> Tuple[Any, Any]:
+        """Processa o prompt inteiro; retorna (logits do último token, KV cache)"""
+        with torch.no_grad():
+            out = self.model(input_ids=input_ids, attention_mask=attention_mask, use_cache=True)
+        return out.logits[:, -1, :], out.past_key_values
+
+    def decode_step(self, input_ids, past_key_values, attention_mask=None) -> Tuple[Any, Any]:
+        """Processa novos tokens (um ou mais) reaproveitando o KV cache"""
+        with torch.no_grad():
+            out = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+        return out.logits[:, -1, :], out.past_key_values
+
+    def generate(self, inputs: Dict[str, Any], streamer=None, **gen_kwargs):
+        """Geração completa (prefill + decode); `streamer` recebe tokens conforme surgem"""
+        if streamer is not None:
+            gen_kwargs["streamer"] = streamer
+        with torch.no_grad():
+            return self.model.generate(**inputs, **gen_kwargs)
+
+    def info(self) -> Dict[str, Any]:
+        return {"backend": self.name, "device": str(self.device)}
+
+
+class TorchBackend(InferenceBackend):
+    """PyTorch eager (AutoModelForCausalLM)"""
+
+    name = "torch"
+    supports_prefix_cache = True
+
+    def __init__(self):
+        super().__init__()
+        self.shared_weights_file = None
+
+    def load_model(self, model_name: str, **kwargs):
+        self.model = AutoModelForCausalLM.from_pretrained(model_name, **kwargs)
+        self.model.eval()
+        # Arquivo de pesos mapeado em memória, compartilhado entre processos (opcional)
+        if Config.SHARED_WEIGHTS_FILE and "load_in_8bit" not in kwargs:
+            self._map_shared_weights(model_name, Config.SHARED_WEIGHTS_FILE)
+
+    def _map_shared_weights(self, model_name: str, path: str):
+        """Substitui os pesos por tensores mapeados (mmap) de `path`.
+
+        As páginas vêm do page cache do SO e são somente leitura, então todos
+        os processos que mapeiam o mesmo arquivo compartilham a mesma memória
+        física. O arquivo é gerado na primeira execução para cada modelo.
+        """
+        path = path.format(model=model_name.strip("/").replace("/", "--"))
+        if not os.path.exists(path):
+            logger.info("Gerando arquivo de pesos compartilhado em %s", path)
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            torch.save(self.model.state_dict(), tmp_path)
+            os.replace(tmp_path, path)
+        state = torch.load(path, mmap=True, weights_only=True, map_location="cpu")
+        self.model.load_state_dict(state, assign=True)
+        self.model.tie_weights()
+        self.shared_weights_file = path
+        logger.info("Pesos mapeados em memória a partir de %s", path)
+
+    @property
+    def device(self):
+        return self.model.device if self.model is not None else torch.device("cpu")
+
+    def info(self) -> Dict[str, Any]:
+        info = super().info()
+        info["shared_weights_file"] = self.shared_weights_file
+        return info
+
+
+class OnnxBackend(InferenceBackend):
+    """ONNX Runtime em CPU, a partir do grafo exportado do modelo configurado.
+
+    O grafo é exportado uma única vez (com KV cache) e reaproveitado de
+    ONNX_CACHE_DIR nas próximas inicializações.
+    """
+
+    name = "onnx"
+
+    def load_model(self, model_name: str, **kwargs):
+        from optimum.onnxruntime import ORTModelForCausalLM
+
+        # Opções específicas do PyTorch não se aplicam ao ONNX Runtime
+        for key in ("device_map", "load_in_8bit"):
+            kwargs.pop(key, None)
+
+        export_dir = os.path.join(ONNX_CACHE_DIR, model_name.strip("/").replace("/", "--"))
+        if os.path.isdir(export_dir) and any(f.endswith(".onnx") for f in os.listdir(export_dir)):
+            logger.info("Carregando grafo ONNX exportado de %s", export_dir)
+            self.model = ORTModelForCausalLM.from_pretrained(
+                export_dir, use_cache=True, provider="CPUExecutionProvider"
+            )
+        else:
+            logger.info("Exportando %s para ONNX (primeira execução)", model_name)
+            self.model = ORTModelForCausalLM.from_pretrained(
+                model_name, export=True, use_cache=True, provider="CPUExecutionProvider", **kwargs
+            )
+            # Grava em um diretório temporário e o move de uma vez: outro worker
+            # exportando ao mesmo tempo nunca vê um grafo pela metade
+            os.makedirs(ONNX_CACHE_DIR, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(prefix=f"{os.path.basename(export_dir)}.", dir=ONNX_CACHE_DIR)
+            try:
+                os.chmod(tmp_dir, 0o755)
+                self.model.save_pretrained(tmp_dir)
+                os.replace(tmp_dir, export_dir)
+            except OSError:
+                # Outro processo já publicou o export (diretório de destino não vazio)
+                logger.info("Export ONNX de %s já publicado por outro processo", model_name)
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def prepare_inputs(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        # O grafo exportado só aceita ids e máscara (sem token_type_ids)
+        return {k: v for k, v in inputs.items() if k in ("input_ids", "attention_mask")}
+
+    def info(self) -> Dict[str, Any]:
+        info = super().info()
+        try:
+            import onnxruntime
+            info["onnxruntime_version"] = onnxruntime.__version__
+        except ImportError:
+            pass
+        return info
+
+
+BACKENDS = {
+    TorchBackend.name: TorchBackend,
+    OnnxBackend.name: OnnxBackend,
+}
+
+
+def create_backend(name: Optional[str] = None) -> InferenceBackend:
+    """Instancia o backend configurado; recorre ao PyTorch se indisponível"""
+    name = (name or Config.INFERENCE_BACKEND).lower()
+    if name not in BACKENDS:
+        logger.warning("Backend de inferência '%s' desconhecido; usando torch", name)
+        return TorchBackend()
+    if name == OnnxBackend.name:
+        try:
+            import optimum.onnxruntime  # noqa: F401
+        except ImportError:
+            logger.warning(
+                "optimum[onnxruntime] não instalado; ignorando INFERENCE_BACKEND=onnx"
+            )
+            return TorchBackend()
+    return BACKENDS[name]()
@@ -0,0 +1,80 @@
+from typing import Any, List, Tuple
+
+import torch
+from transformers import DynamicCache
+
+"""Compressão do KV cache guardado entre turnos.
+
+Chaves são quantizadas por canal (uma escala por dimensão da head, ao longo
+dos tokens) e valores por token, em int8 ou int4 (dois valores por byte),
+com escalas em fp16. O cache volta a fp32/fp16 ao ser reutilizado, então a
+decodificação em si não fica mais lenta.
+"""
+
+QUANT_BITS = {"int8": 8, "int4": 4}
+
+
+def _quantize(x: torch.Tensor, bits: int, dim: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    qmax = 2 ** (bits - 1) - 1
+    scale = x.abs().amax(dim=dim, keepdim=True).clamp(min=1e-8) / qmax
+    q = torch.round(x / scale).clamp(-qmax, qmax).to(torch.int8)
+    if bits == 4:
+        q = (q + 8).to(torch.uint8)
+        if q.shape[-1] % 2:
+            q = torch.nn.functional.pad(q, (0, 1), value=8)
+        q = q[..., 0::2] | (q[..., 1::2] << 4)
+    return q, scale.to(torch.float16)
+
+
+def _dequantize(q: torch.Tensor, scale: torch.Tensor, bits: int, last_dim: int,
+                dtype: torch.dtype) -> torch.Tensor:
+    if bits == 4:
+        low = (q & 0x0F).to(torch.int8) - 8
+        high = (q >> 4).to(torch.int8) - 8
+        q = torch.stack((low, high), dim=-1).flatten(-2)[..., :last_dim]
+    return q.to(dtype) * scale.to(dtype)
+
+
+def cache_nbytes(cache: Any) -> int:
+    """Memória ocupada por um DynamicCache ou QuantizedKV"""
+    if isinstance(cache, QuantizedKV):
+        return cache.nbytes
+    return sum(t.nelement() * t.element_size() for layer in cache.to_legacy_cache() for t in layer)
+
+
+class QuantizedKV:
+    """KV cache quantizado (somente armazenamento)"""
+
+    def __init__(self, cache: DynamicCache, bits: int):
+        self.bits = bits
+        self.layers: List[Tuple[Any, ...]] = []
+        for key, value in cache.to_legacy_cache():
+            qk, sk = _quantize(key, bits, dim=2)
+            qv, sv = _quantize(value, bits, dim=-1)
+            self.layers.append((qk, sk, qv, sv, key.shape[-1], key.dtype))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            t.nelement() * t.element_size()
+            for layer in self.layers for t in layer[:4]
+        )
+
+    def restore(self) -> DynamicCache:
+        legacy = tuple(
+            (_dequantize(qk, sk, self.bits, dim, dtype), _dequantize(qv, sv, self.bits, dim, dtype))
+            for qk, sk, qv, sv, dim, dtype in self.layers
+        )
+        return DynamicCache.from_legacy_cache(legacy)
+
+
+def compress_cache(cache: Any, mode: str) -> Any:
+    """Quantiza o cache conforme `mode`; caches não suportados voltam inalterados"""
+    bits = QUANT_BITS.get(mode)
+    if bits is None or not hasattr(cache, "to_legacy_cache"):
+        return cache
+    return QuantizedKV(cache, bits)
+
+
+def restore_cache(cache: Any) -> Any:
+    return cache.restore() if isinstance(cache, QuantizedKV) else cache
@@ -0,0 +1,153 @@
+import os
+import queue
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from chat.config.settings import Config
+
+logger = logging.getLogger(__name__)
+
+"""Cache de prefixo (KV cache) por sessão e prefill especulativo de rascunhos.
+
+Enquanto o usuário digita, o prompt "histórico + rascunho" é pré-processado
+em background com prioridade baixa e o KV cache resultante é guardado. Quando
+a mensagem final chega, apenas os tokens após o prefixo em comum precisam de
+prefill.
+"""
+
+DRAFT_CACHE_SIZE = int(os.getenv("DRAFT_CACHE_SIZE", 8))
+# Niceness da thread de prefill especulativo (Linux): cede CPU às gerações reais
+DRAFT_THREAD_NICE = int(os.getenv("DRAFT_THREAD_NICE", 10))
+# Prefixos menores que isso não compensam o reaproveitamento
+MIN_REUSE_TOKENS = 16
+
+
+def common_prefix_length(a, b) -> int:
+    """Número de tokens iniciais iguais entre duas sequências 1-D"""
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    diff = (a[:n] != b[:n]).nonzero()
+    return int(diff[0]) if len(diff) else n
+
+
+class PrefixCache:
+    """LRU de (input_ids, KV cache) por sessão.
+
+    Com `quant` (int8/int4) o cache é guardado quantizado e só volta à
+    precisão original ao ser reutilizado; `max_tokens` limita o prefixo
+    guardado por sessão (0 = sem limite). Por padrão vêm de
+    Config.KV_CACHE_QUANT e Config.KV_CACHE_MAX_TOKENS.
+    """
+
+    def __init__(self, max_sessions: int = DRAFT_CACHE_SIZE, quant: Optional[str] = None,
+                 max_tokens: Optional[int] = None):
+        self.max_sessions = max_sessions
+        self.quant = quant if quant is not None else Config.KV_CACHE_QUANT
+        self.max_tokens = max_tokens if max_tokens is not None else Config.KV_CACHE_MAX_TOKENS
+        self._entries: "OrderedDict[str, Tuple[Any, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def put(self, session_id: str, input_ids, past_key_values):
+        from chat.models.kv_quant import compress_cache
+
+        if self.max_tokens and past_key_values.get_seq_length() > self.max_tokens:
+            past_key_values.crop(self.max_tokens)
+        input_ids = input_ids[:past_key_values.get_seq_length()]
+        past_key_values = compress_cache(past_key_values, self.quant)
+        with self._lock:
+            self._entries[session_id] = (input_ids, past_key_values)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_sessions:
+                self._entries.popitem(last=False)
+
+    def take(self, session_id: str, input_ids) -> Optional[Any]:
+        """Remove e retorna o KV cache recortado ao prefixo comum com `input_ids`.
+
+        O cache é consumido: `generate` o estende com os novos tokens.
+        """
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return None
+        cached_ids, past = entry
+        # Ao menos um token precisa passar pelo modelo para gerar logits
+        reuse = min(common_prefix_length(cached_ids, input_ids), len(input_ids) - 1)
+        if reuse < MIN_REUSE_TOKENS:
+            self.misses += 1
+            return None
+        from chat.models.kv_quant import restore_cache
+        past = restore_cache(past)
+        past.crop(reuse)
+        self.hits += 1
+        self.reused_tokens += reuse
+        return past
+
+    def discard(self, session_id: str):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = list(self._entries.values())
+        stored = []
+        if entries:
+            from chat.models.kv_quant import cache_nbytes
+            stored = [cache_nbytes(past) for _, past in entries]
+        return {
+            "cached_sessions": len(entries),
+            "kv_quant": self.quant,
+            "stored_mb": round(sum(stored) / 2**20, 2),
+            "mb_per_session": round(sum(stored) / len(stored) / 2**20, 2) if stored else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused_tokens": self.reused_tokens,
+        }
+
+
+class DraftPrefillWorker:
+    """Thread única de baixa prioridade que faz o prefill dos rascunhos.
+
+    Só o rascunho mais recente de cada sessão é processado; versões
+    anteriores ainda na fila são descartadas.
+    """
+
+    def __init__(self, prefill: Callable[[str, Any], None]):
+        self.prefill = prefill
+        self._pending: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, session_id: str, payload: Any):
+        with self._lock:
+            already_queued = session_id in self._pending
+            self._pending[session_id] = payload
+        if not already_queued:
+            self._queue.put(session_id)
+
+    def cancel(self, session_id: str):
+        with self._lock:
+            self._pending.pop(session_id, None)
+
+    def _run(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), DRAFT_THREAD_NICE)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            session_id = self._queue.get()
+            with self._lock:
+                payload = self._pending.pop(session_id, None)
+            if payload is None:
+                continue
+            try:
+                self.prefill(session_id, payload)
+            except Exception as e:
+                logger.warning(f"Erro no prefill do rascunho: {str(e)}")
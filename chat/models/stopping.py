@@ -0,0 +1,95 @@
+import time
+import threading
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import torch
+from transformers import StoppingCriteria
+
+"""Critérios de parada usados durante a decodificação.
+
+Interrompem a geração assim que uma stop sequence aparece no texto gerado,
+quando a geração é cancelada ou quando o prazo (deadline) da requisição
+expira, evitando decodificar tokens descartados.
+"""
+
+# Stop sequences padrão por template de prompt
+TEMPLATE_STOP_SEQUENCES = {
+    "chatml": ["<|im_end|>", "<|im_start|>"],
+    "transcript": ["\nUser:", "\nSystem:", "\nAssistant:"],
+}
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """Para quando qualquer stop sequence aparece no trecho gerado"""
+
+    def __init__(self, tokenizer, stop_sequences: Sequence[str], prompt_length: int):
+        self.tokenizer = tokenizer
+        self.stop_sequences = [s for s in stop_sequences if s]
+        self.prompt_length = prompt_length
+        # Decodifica só a cauda: cada token gera ao menos 1 caractere
+        self.tail_tokens = max((len(s) for s in self.stop_sequences), default=0) + 2
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs) -> torch.BoolTensor:
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if not self.stop_sequences:
+            return done
+        start = max(self.prompt_length, input_ids.shape[1] - self.tail_tokens)
+        for i, row in enumerate(input_ids[:, start:]):
+            tail = self.tokenizer.decode(row, skip_special_tokens=False)
+            done[i] = any(s in tail for s in self.stop_sequences)
+        return done
+
+
+class CancelCriteria(StoppingCriteria):
+    """Para quando o evento de cancelamento é sinalizado"""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs) -> torch.BoolTensor:
+        return torch.full(
+            (input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device
+        )
+
+
+class DeadlineCriteria(StoppingCriteria):
+    """Para quando o relógio (time.monotonic) passa de `deadline`"""
+
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.expired = False
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs) -> torch.BoolTensor:
+        if not self.expired and time.monotonic() >= self.deadline:
+            self.expired = True
+        return torch.full(
+            (input_ids.shape[0],), self.expired, dtype=torch.bool, device=input_ids.device
+        )
+
+
+class FirstTokenCallback(StoppingCriteria):
+    """Chama `callback` uma vez, quando o primeiro token é gerado (fim do prefill)"""
+
+    def __init__(self, callback: Callable[[], None]):
+        self.callback = callback
+        self.called = False
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs) -> torch.BoolTensor:
+        if not self.called:
+            self.called = True
+            self.callback()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+def trim_at_stop(text: str, stop_sequences: Optional[List[str]]) -> Tuple[str, bool]:
+    """Corta o texto na primeira stop sequence encontrada"""
+    cut = -1
+    for s in stop_sequences or []:
+        if not s:
+            continue
+        idx = text.find(s)
+        if idx != -1 and (cut == -1 or idx < cut):
+            cut = idx
+    if cut == -1:
+        return text, False
+    return text[:cut], True
@@ -1,7 +1,13 @@
 from flask import Blueprint, request, jsonify, Response
-from chat.utils.validators import validate_session_id, validate_message_data, sanitize_message
+from chat.utils.validators import (
+    validate_session_id, validate_message_data, validate_generation_params,
+    sanitize_message, normalize_stop
+)
 from chat.services.chat_service import chat_service
 from chat.models.chat_model import chat_model
+from chat.utils.profiling import profiler
+from chat.config.settings import Config
+import hmac
 import json
 import logging
 
@@ -69,6 +75,9 @@ def send_message(session_id):
         user_message = sanitize_message(data['message'])
         max_length = data.get('max_length', 1000)
         temperature = data.get('temperature', 0.7)
+        stop = normalize_stop(data.get('stop'))
+        n = data.get('n', 1)
+        timeout = data.get('timeout')
         
         # Gera resposta
         if not chat_service.model_loaded:
@@ -77,7 +86,10 @@ def send_message(session_id):
             session_id=session_id,
             message=user_message,
             max_length=max_length,
-            temperature=temperature
+            temperature=temperature,
+            stop=stop,
+            n=n,
+            timeout=timeout
         )
         
         return jsonify(response_data)
@@ -89,15 +101,97 @@ def send_message(session_id):
         logger.error(f"Erro ao processar mensagem: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@chat_bp.route('/session/<session_id>/regenerate', methods=['POST'])
+def regenerate(session_id):
+    """Gera novamente a última resposta, substituindo-a no histórico"""
+    try:
+        if not validate_session_id(session_id):
+            return jsonify({"error": "Session ID inválido"}), 400
+        
+        data = request.get_json(silent=True) or {}
+        is_valid, error_msg = validate_generation_params(data)
+        if not is_valid:
+            return jsonify({"error": error_msg}), 400
+        
+        if not chat_service.model_loaded:
+            return jsonify({"error": "Modelo carregando"}), 503
+        response_data = chat_service.regenerate(
+            session_id=session_id,
+            max_length=data.get('max_length', 1000),
+            temperature=data.get('temperature', 0.7),
+            stop=normalize_stop(data.get('stop')),
+            n=data.get('n', 1),
+            timeout=data.get('timeout')
+        )
+        
+        return jsonify(response_data)
+        
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 409
+    except ValueError as e:
+        logger.error(f"Sessão não encontrada: {str(e)}")
+        return jsonify({"error": "Sessão não encontrada"}), 404
+    except Exception as e:
+        logger.error(f"Erro ao regenerar resposta: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@chat_bp.route('/session/<session_id>/draft', methods=['POST'])
+def submit_draft(session_id):
+    """Recebe o rascunho em digitação e agenda o prefill especulativo"""
+    try:
+        if not validate_session_id(session_id):
+            return jsonify({"error": "Session ID inválido"}), 400
+        
+        data = request.get_json()
+        is_valid, error_msg = validate_message_data(data)
+        if not is_valid:
+            return jsonify({"error": error_msg}), 400
+        
+        if not chat_service.model_loaded:
+            return jsonify({"error": "Modelo carregando"}), 503
+        accepted = chat_service.submit_draft(session_id, sanitize_message(data['message']))
+        return jsonify({
+            "session_id": session_id,
+            "accepted": accepted
+        }), 202
+        
+    except ValueError as e:
+        logger.error(f"Sessão não encontrada: {str(e)}")
+        return jsonify({"error": "Sessão não encontrada"}), 404
+    except Exception as e:
+        logger.error(f"Erro ao processar rascunho: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @chat_bp.route('/session/<session_id>/history', methods=['GET'])
 def get_history(session_id):
-    """Retorna o histórico de uma sessão"""
+    """Retorna o histórico de uma sessão.
+
+    Aceita `since=<seq>` para retornar apenas mensagens novas (e, em
+    `removed`, os seqs já entregues que foram removidos) e responde 304
+    quando o `If-None-Match` do cliente corresponde ao ETag atual.
+    """
     try:
-        history = chat_model.get_chat_history(session_id)
-        return jsonify({
+        since = request.args.get('since', type=int)
+        last_seq = chat_model.get_history_seq(session_id)
+        # O ETag depende só do cursor e do último seq: evita serializar o histórico
+        etag = f"{session_id}-{last_seq}-{since if since is not None else 'all'}"
+        if etag in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        history = chat_model.get_chat_history(session_id, since=since)
+        payload = {
             "session_id": session_id,
-            "history": history
-        })
+            "history": history,
+            "last_seq": last_seq
+        }
+        if since is not None:
+            # Mensagens já entregues ao cursor e removidas depois (ex.: regenerate)
+            payload["removed"] = chat_model.get_removed_seqs(session_id, since)
+        response = jsonify(payload)
+        response.set_etag(etag)
+        return response
     except Exception as e:
         logger.error(f"Erro ao obter histórico: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -115,39 +209,79 @@ def clear_session(session_id):
         logger.error(f"Erro ao limpar sessão: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@chat_bp.route('/session/<session_id>/cancel', methods=['POST'])
+def cancel_generation(session_id):
+    """Cancela a geração em andamento da sessão (finish_reason: cancelled).
+
+    Só alcança gerações deste processo: exige worker com threads (gthread)
+    e roteamento sticky quando há mais de um worker.
+    """
+    try:
+        cancelled = chat_model.cancel_generation(session_id)
+        return jsonify({
+            "session_id": session_id,
+            "cancelled": cancelled
+        })
+    except Exception as e:
+        logger.error(f"Erro ao cancelar geração: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @chat_bp.route('/session/<session_id>/stream', methods=['POST'])
 def stream_message(session_id):
     """Endpoint para streaming de respostas (SSE)"""
     try:
+        if not validate_session_id(session_id):
+            return jsonify({"error": "Session ID inválido"}), 400
+        
         data = request.get_json()
         
-        if not data or 'message' not in data:
-            return jsonify({"error": "Mensagem é obrigatória"}), 400
+        # Mesma validação de /message (n, stop, timeout, max_length...)
+        is_valid, error_msg = validate_message_data(data)
+        if not is_valid:
+            return jsonify({"error": error_msg}), 400
         
-        user_message = data['message']
+        user_message = sanitize_message(data['message'])
         max_length = data.get('max_length', 1000)
         temperature = data.get('temperature', 0.7)
+        stop = normalize_stop(data.get('stop'))
+        n = data.get('n', 1)
+        timeout = data.get('timeout')
         
         def generate():
             try:
                 # Gera resposta
-                response_data = chat_model.generate_response(
+                response_data = chat_service.send_message(
                     session_id=session_id,
-                    user_message=user_message,
+                    message=user_message,
                     max_length=max_length,
-                    temperature=temperature
+                    temperature=temperature,
+                    stop=stop,
+                    n=n,
+                    timeout=timeout
                 )
                 
-                # Envia resposta em chunks para simular streaming
-                response_text = response_data['response']
+                # Envia resposta em chunks para simular streaming; com n > 1 os
+                # candidatos são intercalados e identificados por 'index'
+                candidates = response_data.get('candidates') or [response_data]
                 chunk_size = 50
+                longest = max(len(c['response']) for c in candidates)
                 
-                for i in range(0, len(response_text), chunk_size):
-                    chunk = response_text[i:i + chunk_size]
-                    yield f"data: {json.dumps({'chunk': chunk, 'done': False})}\n\n"
+                for i in range(0, longest, chunk_size):
+                    for index, candidate in enumerate(candidates):
+                        chunk = candidate['response'][i:i + chunk_size]
+                        if chunk:
+                            yield f"data: {json.dumps({'chunk': chunk, 'index': index, 'done': False})}\n\n"
                 
                 # Sinaliza fim do streaming
-                yield f"data: {json.dumps({'done': True, 'session_id': session_id})}\n\n"
+                done = {
+                    'done': True,
+                    'session_id': session_id,
+                    'finish_reason': response_data['finish_reason'],
+                    'degradation_level': response_data['degradation_level']
+                }
+                if 'candidates' in response_data:
+                    done['finish_reasons'] = [c['finish_reason'] for c in candidates]
+                yield f"data: {json.dumps(done)}\n\n"
                 
             except Exception as e:
                 yield f"data: {json.dumps({'error': str(e)})}\n\n"
@@ -158,6 +292,35 @@ def stream_message(session_id):
         logger.error(f"Erro no streaming: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+def _is_admin() -> bool:
+    """Valida o token admin (Authorization: Bearer <ADMIN_TOKEN>)"""
+    admin_token = Config.ADMIN_TOKEN
+    if not admin_token:
+        return False
+    auth = request.headers.get('Authorization', '')
+    return auth.startswith('Bearer ') and hmac.compare_digest(auth[7:], admin_token)
+
+@chat_bp.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+def admin_profile():
+    """Arma (POST), consulta (GET) ou desarma (DELETE) o profiling da geração"""
+    if not _is_admin():
+        return jsonify({"error": "Acesso negado"}), 403
+    try:
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            n_requests = data.get('requests', 0 if data.get('window_seconds') else 5)
+            window_seconds = data.get('window_seconds', 0)
+            if (not isinstance(n_requests, int) or not 0 <= n_requests <= 100
+                    or not isinstance(window_seconds, (int, float)) or not 0 <= window_seconds <= 3600):
+                return jsonify({"error": "requests deve estar entre 0 e 100 e window_seconds entre 0 e 3600"}), 400
+            return jsonify(profiler.arm(requests=n_requests, window_seconds=window_seconds))
+        if request.method == 'DELETE':
+            return jsonify(profiler.disarm())
+        return jsonify(profiler.get_status())
+    except Exception as e:
+        logger.error(f"Erro no profiling: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 # Middleware para logging de requisições
 @chat_bp.before_request
 def log_request():
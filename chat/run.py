@@ -13,7 +13,6 @@ if str(PROJECT_ROOT) not in sys.path:
     sys.path.insert(0, str(PROJECT_ROOT))
 
 from chat.app import create_app
-from chat.services.chat_service import chat_service
 
 # Configura logging
 logging.basicConfig(
@@ -24,13 +23,9 @@ logging.basicConfig(
 def main():
     """Função principal"""
     try:
-        # Cria a aplicação Flask
+        # Cria a aplicação Flask (já inicia o carregamento do modelo em background)
         app = create_app()
         
-        # Inicia o carregamento do modelo em background
-        print("🚀 Iniciando carregamento do modelo em background...")
-        chat_service.start_model_loading()
-        
         # Configurações do servidor
         port = int(os.getenv('PORT', 5000))
         debug = os.getenv('DEBUG', 'True').lower() == 'true'
@@ -1,26 +1,78 @@
+import os
+import gc
 import threading
 import time
 import logging
-from typing import Optional
+from typing import Any, Dict, Optional
+from chat.config.settings import Config
 from chat.models.chat_model import chat_model
 
 logger = logging.getLogger(__name__)
 
+# Níveis de degradação sob carga: cada nível reduz tokens gerados, orçamento
+# do prompt e turnos de histórico enviados ao modelo
+DEGRADATION_LEVELS = [
+    {"max_new_tokens": 384, "max_prompt_tokens": 1024, "history_turns": Config.MAX_HISTORY_LENGTH},
+    {"max_new_tokens": 256, "max_prompt_tokens": 768, "history_turns": max(1, Config.MAX_HISTORY_LENGTH // 2)},
+    {"max_new_tokens": 128, "max_prompt_tokens": 512, "history_turns": max(1, Config.MAX_HISTORY_LENGTH // 4)},
+    {"max_new_tokens": 64, "max_prompt_tokens": 256, "history_turns": 1},
+]
+
 class ChatService:
     def __init__(self):
         self.model_loading = False
         self.model_loaded = False
         self.loading_thread: Optional[threading.Thread] = None
+        self._loading_lock = threading.Lock()
+        # Estado de carga para a política de degradação
+        self.in_flight = 0
+        self.latency_ewma: Optional[float] = None
+        self.degradation_level = 0
+        self._last_finished_at = time.time()
+        # Gerações interrompidas pelo prazo (REQUEST_TIMEOUT ou `timeout` da requisição)
+        self.deadline_hits = 0
+        self._load_lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork_in_child)
         
     def start_model_loading(self):
         """Inicia o carregamento do modelo em uma thread separada"""
-        if self.model_loading or self.model_loaded:
-            return
-            
-        self.model_loading = True
-        self.loading_thread = threading.Thread(target=self._load_model_async)
-        self.loading_thread.daemon = True
-        self.loading_thread.start()
+        with self._loading_lock:
+            if self.model_loading or self.model_loaded:
+                return
+                
+            self.model_loading = True
+            self.loading_thread = threading.Thread(target=self._load_model_async)
+            self.loading_thread.daemon = True
+            self.loading_thread.start()
+
+    def preload_model(self) -> bool:
+        """Carrega o modelo de forma síncrona no processo atual (antes do fork).
+
+        Usado com `gunicorn --preload`: os workers herdam os pesos já carregados
+        e compartilham as mesmas páginas físicas (copy-on-write).
+        """
+        with self._loading_lock:
+            if self.model_loaded:
+                return True
+            self.model_loading = True
+        self._load_model_async()
+        if self.model_loaded:
+            # Objetos sobreviventes ficam fora do GC: evita que coletas nos
+            # workers escrevam nos cabeçalhos e quebrem o compartilhamento
+            gc.freeze()
+        return self.model_loaded
+
+    def _after_fork_in_child(self):
+        """Restaura o estado de carregamento no processo filho após um fork"""
+        # Locks e threads não sobrevivem ao fork: a thread de carregamento do
+        # pai não existe no filho e o lock pode ter sido copiado adquirido
+        self._loading_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.in_flight = 0
+        if self.loading_thread is not None and not self.model_loaded:
+            self.model_loading = False
+        self.loading_thread = None
         
     def _load_model_async(self):
         """Carrega o modelo de forma assíncrona"""
@@ -55,8 +107,66 @@ class ChatService:
         return {
             "model_loading": self.model_loading,
             "model_loaded": self.model_loaded,
-            "model_info": chat_model.get_model_info() if self.model_loaded else None
+            "model_info": chat_model.get_model_info() if self.model_loaded else None,
+            "load": self.get_load_status()
         }
+
+    def get_load_status(self) -> Dict[str, Any]:
+        """Estado da política de degradação sob carga"""
+        with self._load_lock:
+            # Reavalia o nível mesmo sem requisições chegando
+            self._recover_if_idle(active=0)
+        return {
+            "degradation_level": self.degradation_level,
+            "in_flight": self.in_flight,
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "deadline_hits": self.deadline_hits,
+            "request_timeout_seconds": Config.REQUEST_TIMEOUT,
+            "limits": DEGRADATION_LEVELS[self.degradation_level]
+        }
+
+    def _update_degradation_level(self):
+        """Sobe um nível sob pressão; desce um nível quando a carga alivia.
+
+        Pressão: fila (requisições em andamento) acima de LOAD_QUEUE_THRESHOLD
+        ou latência média acima de LATENCY_SLO_SECONDS. A recuperação exige
+        fila e latência bem abaixo dos limites (histerese); após
+        LOAD_RECOVERY_SECONDS sem tráfego o nível volta direto a 0.
+        LATENCY_SLO_SECONDS=0 desativa o critério de latência.
+        """
+        # A requisição atual já foi contada em in_flight
+        self._recover_if_idle(active=1)
+        latency = self.latency_ewma or 0.0
+        slo = Config.LATENCY_SLO_SECONDS
+        overloaded = (self.in_flight > Config.LOAD_QUEUE_THRESHOLD
+                      or (slo > 0 and latency > slo))
+        relaxed = (self.in_flight <= max(1, Config.LOAD_QUEUE_THRESHOLD // 2)
+                   and (slo <= 0 or latency < slo * 0.6))
+        level = self.degradation_level
+        if overloaded and level < len(DEGRADATION_LEVELS) - 1:
+            level += 1
+        elif relaxed and level > 0:
+            level -= 1
+        if level != self.degradation_level:
+            logger.warning(
+                "Nível de degradação %d -> %d (em andamento: %d, latência média: %.2fs)",
+                self.degradation_level, level, self.in_flight, latency
+            )
+            self.degradation_level = level
+    
+    def _recover_if_idle(self, active: int):
+        """Sem tráfego por LOAD_RECOVERY_SECONDS, descarta a latência média e volta ao nível 0.
+
+        Chamado com `_load_lock`; `active` é o número de requisições em
+        andamento que ainda contam como ociosidade (a própria requisição).
+        """
+        if self.in_flight > active or time.time() - self._last_finished_at <= Config.LOAD_RECOVERY_SECONDS:
+            return
+        # A latência média antiga não representa a carga atual
+        self.latency_ewma = None
+        if self.degradation_level:
+            logger.warning("Nível de degradação %d -> 0 (sem tráfego recente)", self.degradation_level)
+            self.degradation_level = 0
     
     def create_session(self) -> str:
         """Cria uma nova sessão de chat"""
@@ -64,11 +174,68 @@ class ChatService:
             raise RuntimeError("Modelo não está carregado")
         return chat_model.create_chat_session()
     
+    def submit_draft(self, session_id: str, draft: str) -> bool:
+        """Agenda o prefill especulativo do rascunho; ignorado sob carga"""
+        if not self.model_loaded:
+            raise RuntimeError("Modelo não está carregado")
+        if self.degradation_level > 0:
+            return False
+        limits = DEGRADATION_LEVELS[0]
+        return chat_model.submit_draft(
+            session_id, draft,
+            history_turns=limits["history_turns"],
+            max_prompt_tokens=limits["max_prompt_tokens"]
+        )
+
     def send_message(self, session_id: str, message: str, **kwargs):
-        """Envia uma mensagem e retorna a resposta"""
+        """Envia uma mensagem e retorna a resposta, aplicando os limites do nível de carga"""
+        return self._run_generation(chat_model.generate_response, session_id, message, **kwargs)
+
+    def regenerate(self, session_id: str, **kwargs):
+        """Gera novamente a última resposta da sessão"""
+        return self._run_generation(chat_model.regenerate_response, session_id, **kwargs)
+
+    def _run_generation(self, generate, session_id: str, *args, **kwargs):
+        """Executa uma geração contabilizando a carga e aplicando os limites do nível atual"""
         if not self.model_loaded:
             raise RuntimeError("Modelo não está carregado")
-        return chat_model.generate_response(session_id, message, **kwargs)
+
+        start = time.time()
+        with self._load_lock:
+            self.in_flight += 1
+            self._update_degradation_level()
+            level = self.degradation_level
+        # Tudo após o incremento fica no try: parâmetros inválidos não podem
+        # deixar `in_flight` inflado (e o serviço preso em degradação)
+        try:
+            limits = DEGRADATION_LEVELS[level]
+            kwargs["max_length"] = min(kwargs.get("max_length", limits["max_new_tokens"]),
+                                       limits["max_new_tokens"])
+            kwargs["max_prompt_tokens"] = limits["max_prompt_tokens"]
+            kwargs["history_turns"] = limits["history_turns"]
+            if level > 0:
+                # Sob carga, um único candidato por requisição
+                kwargs["n"] = 1
+            # O `timeout` da requisição só pode encurtar o prazo global
+            timeout = kwargs.get("timeout")
+            if Config.REQUEST_TIMEOUT > 0:
+                timeout = min(timeout, Config.REQUEST_TIMEOUT) if timeout else Config.REQUEST_TIMEOUT
+            kwargs["timeout"] = timeout
+
+            response = generate(session_id, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            with self._load_lock:
+                self.in_flight -= 1
+                self._last_finished_at = time.time()
+                alpha = Config.LATENCY_EWMA_ALPHA
+                self.latency_ewma = (elapsed if self.latency_ewma is None
+                                     else alpha * elapsed + (1 - alpha) * self.latency_ewma)
+        if response.get("finish_reason") == "deadline":
+            with self._load_lock:
+                self.deadline_hits += 1
+        response["degradation_level"] = level
+        return response
 
 # Instância global do serviço
 chat_service = ChatService()
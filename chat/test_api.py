@@ -84,6 +84,128 @@ def test_send_message(session_id):
         print(f"❌ Erro: {e}")
         return False
 
+def test_candidates(session_id):
+    """Testa múltiplas respostas candidatas (n) e o limite de n"""
+    print("🔍 Testando respostas candidatas...")
+    try:
+        response = requests.post(
+            f"{BASE_URL}/session/{session_id}/message",
+            json={"message": "Me dê uma sugestão", "max_length": 50, "n": 2}
+        )
+        if response.status_code != 200:
+            print(f"❌ Falha ao gerar candidatos: {response.status_code}")
+            return False
+        data = response.json()
+        # Sob carga o serviço gera um único candidato
+        expected = 2 if data.get('degradation_level', 0) == 0 else None
+        if expected and len(data.get('candidates', [])) != expected:
+            print(f"❌ Esperava {expected} candidatos: {len(data.get('candidates', []))}")
+            return False
+        for route in ("message", "stream"):
+            response = requests.post(
+                f"{BASE_URL}/session/{session_id}/{route}",
+                json={"message": "oi", "n": 12}
+            )
+            if response.status_code != 400:
+                print(f"❌ n=12 em /{route} deveria retornar 400: {response.status_code}")
+                return False
+        print("✅ Candidatos e limite de n OK")
+        return True
+    except Exception as e:
+        print(f"❌ Erro: {e}")
+        return False
+
+def test_regenerate(session_id):
+    """Testa a regeneração da última resposta"""
+    print("🔍 Testando regeneração...")
+    try:
+        history = requests.get(f"{BASE_URL}/session/{session_id}/history").json()
+        last_seq = history.get('last_seq')
+        response = requests.post(
+            f"{BASE_URL}/session/{session_id}/regenerate",
+            json={"max_length": 50}
+        )
+        if response.status_code != 200:
+            print(f"❌ Falha ao regenerar: {response.status_code}")
+            return False
+        data = response.json()
+        if data.get('replaces_seq') != last_seq:
+            print(f"❌ replaces_seq deveria ser {last_seq}: {data.get('replaces_seq')}")
+            return False
+        # Cliente que já tinha a resposta antiga fica sabendo da remoção pelo cursor
+        synced = requests.get(
+            f"{BASE_URL}/session/{session_id}/history",
+            params={"since": last_seq}
+        ).json()
+        if synced.get('removed') != [last_seq] or [m['seq'] for m in synced.get('history', [])] != [data.get('seq')]:
+            print(f"❌ since={last_seq} deveria trazer removed=[{last_seq}] e a nova resposta: {synced}")
+            return False
+
+        # Sessão sem mensagem do usuário: nada a regenerar
+        empty = requests.post(f"{BASE_URL}/session/create").json().get('session_id')
+        response = requests.post(f"{BASE_URL}/session/{empty}/regenerate")
+        requests.delete(f"{BASE_URL}/session/{empty}/clear")
+        if response.status_code != 409:
+            print(f"❌ Regenerar sessão vazia deveria retornar 409: {response.status_code}")
+            return False
+        print("✅ Regeneração OK")
+        return True
+    except Exception as e:
+        print(f"❌ Erro: {e}")
+        return False
+
+def test_draft_and_cancel(session_id):
+    """Testa o envio de rascunho e o cancelamento sem geração em andamento"""
+    print("🔍 Testando rascunho e cancelamento...")
+    try:
+        response = requests.post(
+            f"{BASE_URL}/session/{session_id}/draft",
+            json={"message": "Estou digitando uma pergunta"}
+        )
+        if response.status_code != 202 or 'accepted' not in response.json():
+            print(f"❌ Rascunho deveria retornar 202: {response.status_code}")
+            return False
+        response = requests.post(f"{BASE_URL}/session/{session_id}/cancel")
+        if response.status_code != 200 or response.json().get('cancelled') is not False:
+            print(f"❌ Cancelar sem geração deveria retornar cancelled=false: {response.text}")
+            return False
+        print("✅ Rascunho e cancelamento OK")
+        return True
+    except Exception as e:
+        print(f"❌ Erro: {e}")
+        return False
+
+def test_deadline(session_id):
+    """Testa o prazo por requisição (timeout) e o contador de deadline_hits"""
+    print("🔍 Testando prazo de geração...")
+    try:
+        for timeout in (0, -1, True):
+            response = requests.post(
+                f"{BASE_URL}/session/{session_id}/message",
+                json={"message": "oi", "timeout": timeout}
+            )
+            if response.status_code != 400:
+                print(f"❌ timeout={timeout!r} deveria retornar 400: {response.status_code}")
+                return False
+
+        hits_before = requests.get(f"{BASE_URL}/status").json()['load']['deadline_hits']
+        response = requests.post(
+            f"{BASE_URL}/session/{session_id}/message",
+            json={"message": "Conte uma história longa", "max_length": 384, "timeout": 0.001}
+        )
+        if response.status_code != 200 or response.json().get('finish_reason') != 'deadline':
+            print(f"❌ timeout mínimo deveria retornar finish_reason=deadline: {response.text[:200]}")
+            return False
+        hits_after = requests.get(f"{BASE_URL}/status").json()['load']['deadline_hits']
+        if hits_after != hits_before + 1:
+            print(f"❌ deadline_hits deveria ir de {hits_before} para {hits_before + 1}: {hits_after}")
+            return False
+        print("✅ Prazo de geração OK")
+        return True
+    except Exception as e:
+        print(f"❌ Erro: {e}")
+        return False
+
 def test_get_history(session_id):
     """Testa a obtenção do histórico"""
     print("🔍 Testando obtenção do histórico...")
@@ -93,6 +215,25 @@ def test_get_history(session_id):
             data = response.json()
             history = data.get('history', [])
             print(f"✅ Histórico obtido: {len(history)} mensagens")
+
+            # Sincronização incremental: cursor `since` e ETag
+            last_seq = data.get('last_seq', 0)
+            response = requests.get(
+                f"{BASE_URL}/session/{session_id}/history",
+                params={"since": last_seq}
+            )
+            if response.status_code != 200 or response.json().get('history'):
+                print("❌ Cursor 'since' deveria retornar histórico vazio")
+                return False
+            response = requests.get(
+                f"{BASE_URL}/session/{session_id}/history",
+                params={"since": last_seq},
+                headers={"If-None-Match": response.headers.get('ETag', '')}
+            )
+            if response.status_code != 304:
+                print(f"❌ ETag deveria retornar 304: {response.status_code}")
+                return False
+            print("✅ Cursor 'since' e ETag OK")
             return True
         else:
             print(f"❌ Falha ao obter histórico: {response.status_code}")
@@ -150,6 +291,17 @@ def main():
     
     print()
     
+    # Testa candidatos, regeneração, rascunho e cancelamento
+    test_candidates(session_id)
+    print()
+    test_regenerate(session_id)
+    print()
+    test_draft_and_cancel(session_id)
+    print()
+    test_deadline(session_id)
+    
+    print()
+    
     # Testa obtenção do histórico
     test_get_history(session_id)
     
@@ -0,0 +1,209 @@
+import os
+import sys
+import json
+import time
+import threading
+import logging
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from chat.config.settings import Config
+
+logger = logging.getLogger(__name__)
+
+"""Profiling sob demanda do caminho de geração.
+
+Quando armado (endpoint admin ou sinal), captura para as próximas N
+requisições (ou por uma janela de tempo) o trace de operadores do
+torch.profiler em formato Chrome trace, um perfil Python por amostragem
+em formato "folded" (flamegraph.pl / speedscope) e os tempos por etapa.
+Desarmado, `stage()` e `request()` retornam um contexto nulo.
+"""
+
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", 0.005))
+
+_NULL_CONTEXT = nullcontext()
+
+
+class _StackSampler:
+    """Amostra periodicamente a pilha Python de uma thread"""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write_folded(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class GenerationProfiler:
+    """Controla o profiling das próximas requisições de geração"""
+
+    def __init__(self, output_dir: Optional[str] = None):
+        self.output_dir = output_dir or Config.PROFILE_DIR
+        self.remaining = 0
+        self.deadline: Optional[float] = None
+        self.captured = 0
+        self._lock = threading.Lock()
+        # Thread da requisição sendo perfilada (uma por vez)
+        self._active_thread: Optional[int] = None
+        self._stages: Dict[str, float] = {}
+
+    @property
+    def armed(self) -> bool:
+        if self.deadline is not None and time.time() > self.deadline:
+            self.deadline = None
+        return self.remaining > 0 or self.deadline is not None
+
+    @property
+    def active(self) -> bool:
+        """Se a requisição da thread atual está sendo perfilada"""
+        return self._active_thread == threading.get_ident()
+
+    def arm(self, requests: int = 0, window_seconds: float = 0) -> Dict[str, Any]:
+        """Arma o profiling para N requisições e/ou uma janela de tempo"""
+        with self._lock:
+            self.remaining = max(0, int(requests))
+            self.deadline = time.time() + window_seconds if window_seconds > 0 else None
+        logger.info("Profiling armado: %s", self.get_status())
+        return self.get_status()
+
+    def disarm(self) -> Dict[str, Any]:
+        with self._lock:
+            self.remaining = 0
+            self.deadline = None
+        return self.get_status()
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "armed": self.armed,
+            "remaining_requests": self.remaining,
+            "window_remaining_seconds": round(self.deadline - time.time(), 1) if self.deadline else 0,
+            "captured": self.captured,
+            "output_dir": os.path.abspath(self.output_dir),
+        }
+
+    def _claim(self) -> bool:
+        """Reserva a captura para a requisição atual, se armado e livre"""
+        if not self.armed:
+            return False
+        with self._lock:
+            if self._active_thread is not None or not self.armed:
+                return False
+            if self.deadline is None:
+                self.remaining -= 1
+            self._active_thread = threading.get_ident()
+            self._stages = {}
+            return True
+
+    def stage(self, name: str):
+        """Marca uma etapa da geração (no-op quando não há captura ativa)"""
+        if not self.active:
+            return _NULL_CONTEXT
+        return self._timed_stage(name)
+
+    @contextmanager
+    def _timed_stage(self, name: str):
+        import torch
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+        self._stages[name] = self._stages.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def mark(self, name: str, start: float):
+        """Registra uma etapa medida externamente (início em perf_counter)"""
+        if self.active:
+            self._stages[name] = self._stages.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def request(self, label: str = "request"):
+        """Envolve uma requisição de geração; captura se houver orçamento"""
+        if not self.armed or not self._claim():
+            return _NULL_CONTEXT
+        return self._capture(label)
+
+    @contextmanager
+    def _capture(self, label: str):
+        from torch.profiler import profile, ProfilerActivity
+
+        sampler = _StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL)
+        prof = profile(activities=[ProfilerActivity.CPU], record_shapes=True)
+        start = time.perf_counter()
+        try:
+            sampler.start()
+            with prof:
+                yield
+        finally:
+            sampler.stop()
+            self._stages["total"] = (time.perf_counter() - start) * 1000
+            try:
+                self._write(label, prof, sampler)
+            except Exception as e:
+                logger.error(f"Erro ao salvar profiling: {str(e)}")
+            finally:
+                with self._lock:
+                    self._active_thread = None
+                    self.captured += 1
+
+    def _write(self, label: str, prof, sampler: _StackSampler):
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(
+            self.output_dir, f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{label}"
+        )
+        prof.export_chrome_trace(f"{prefix}-torch.json")
+        sampler.write_folded(f"{prefix}-python.folded")
+        with open(f"{prefix}-stages.json", "w", encoding="utf-8") as f:
+            json.dump({k: round(v, 3) for k, v in self._stages.items()}, f, indent=2)
+        logger.info("Profiling salvo em %s-*", prefix)
+
+
+def install_signal_handler(signum: Optional[int] = None, requests: int = 5) -> bool:
+    """Arma o profiling para N requisições ao receber o sinal (padrão SIGRTMIN).
+
+    SIGUSR1/SIGUSR2 pertencem ao gunicorn (reabrir logs / upgrade do binário
+    no master; os workers os restauram para SIG_DFL), então usamos o
+    primeiro sinal de tempo real, que o gunicorn não trata. O handler
+    instalado no master é herdado pelos workers no fork.
+    """
+    import signal
+    signum = signum if signum is not None else getattr(signal, "SIGRTMIN", None)
+    if signum is None:
+        return False
+    def _handler(*_):
+        # Fora do handler: arm() usa um lock que a thread interrompida pode estar segurando
+        threading.Thread(target=profiler.arm, kwargs={"requests": requests}, daemon=True).start()
+
+    try:
+        signal.signal(signum, _handler)
+    except ValueError:
+        # signal.signal só pode ser chamado na thread principal
+        return False
+    return True
+
+
+# Instância global do profiler
+profiler = GenerationProfiler()
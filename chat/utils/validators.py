@@ -24,7 +24,10 @@ def validate_message_data(data: Dict[str, Any]) -> tuple[bool, Optional[str]]:
     if len(message) > 1000:
         return False, "Mensagem muito longa (máximo 1000 caracteres)"
     
-    # Valida parâmetros opcionais
+    return validate_generation_params(data)
+
+def validate_generation_params(data: Dict[str, Any]) -> tuple[bool, Optional[str]]:
+    """Valida os parâmetros opcionais de geração"""
     max_length = data.get('max_length', 1000)
     if not isinstance(max_length, int) or max_length < 1 or max_length > 2000:
         return False, "max_length deve ser um inteiro entre 1 e 2000"
@@ -33,8 +36,34 @@ def validate_message_data(data: Dict[str, Any]) -> tuple[bool, Optional[str]]:
     if not isinstance(temperature, (int, float)) or temperature < 0.0 or temperature > 2.0:
         return False, "temperature deve ser um número entre 0.0 e 2.0"
     
+    n = data.get('n', 1)
+    # bool é subclasse de int: `true` não pode virar n=1
+    if isinstance(n, bool) or not isinstance(n, int) or n < 1 or n > 4:
+        return False, "n deve ser um inteiro entre 1 e 4"
+    
+    stop = data.get('stop')
+    if stop is not None:
+        if isinstance(stop, str):
+            stop = [stop]
+        if (not isinstance(stop, list) or len(stop) > 4
+                or not all(isinstance(s, str) and 0 < len(s) <= 32 for s in stop)):
+            return False, "stop deve ser uma lista de até 4 strings (máximo 32 caracteres cada)"
+    
+    timeout = data.get('timeout')
+    if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float))
+                                or timeout <= 0):
+        return False, "timeout deve ser um número positivo (segundos)"
+    
     return True, None
 
+def normalize_stop(stop: Any) -> Optional[list]:
+    """Normaliza o parâmetro `stop` (string única ou lista) para lista"""
+    if stop is None:
+        return None
+    if isinstance(stop, str):
+        return [stop]
+    return list(stop)
+
 def sanitize_message(message: str) -> str:
     """Remove caracteres potencialmente perigosos da mensagem"""
     # Remove caracteres de controle exceto quebras de linha